@@ -24,7 +24,7 @@ fi
 
 # Crear directorios de datos
 echo "Creando directorios de datos..."
-mkdir -p stack_data/{stt/app,llm/models,tts/app}
+mkdir -p stack_data/{stt/app,stt/cache,llm/models,tts/app,tts/onnx}
 
 # Verificar red externa
 if ! docker network inspect vpn-proxy >/dev/null 2>&1; then
@@ -70,6 +70,13 @@ if [ "$LLM_DOCS" != "$LLM_CHAT" ] && [ "$LLM_DOCS" != "$LLM_IMG" ]; then
     docker exec llm ollama pull "$LLM_DOCS" || echo "Modelo $LLM_DOCS ya existe o error"
 fi
 
+# Modelo de embeddings (solo si el cache semantico esta activo)
+if [ "${SEMANTIC_CACHE:-false}" = "true" ]; then
+    LLM_EMBED=${LLM_EMBED_MODEL:-paraphrase-multilingual}
+    echo "Descargando modelo de embeddings: $LLM_EMBED"
+    docker exec llm ollama pull "$LLM_EMBED" || echo "Modelo $LLM_EMBED ya existe o error"
+fi
+
 echo "Modelos instalados:"
 docker exec llm ollama list
 
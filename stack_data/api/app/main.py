@@ -12,16 +12,35 @@ Siempre retorna texto y audio en la respuesta.
 """
 import os
 import io
+import re
+import json
+import wave
 import base64
+import asyncio
+import hashlib
+import time
+import zipfile
+import unicodedata
+import logging
 import tempfile
-import subprocess
+from pathlib import Path
 import httpx
-import redis
+import redis.asyncio as aioredis
+import numpy as np
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 from pydantic import BaseModel
 from typing import Optional, List
-from pdf2image import convert_from_bytes
-from PIL import Image
+from langdetect import detect, DetectorFactory, LangDetectException
+
+# langdetect es aleatorio sin semilla; fijarla hace la detección determinista
+DetectorFactory.seed = 0
+
+# Logging (nivel configurable con LOG_LEVEL)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="[API] %(levelname)s %(message)s"
+)
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="API Unificada",
@@ -43,32 +62,203 @@ SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Eres un asistente útil. Responde de
 # Redis para guardar idioma del usuario
 REDIS_URL = os.getenv("REDIS_URL", "redis://:orquestador123@redis-orquestador:6379/0")
 HISTORY_TTL = 3600  # 1 hora
+LANGUAGE_CACHE_TTL = 86400  # 1 día
 
-# Conexión a Redis (lazy init)
+# Timeouts de Redis (segundos): si no responde, se sigue sin cache
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+
+# Conexión async a Redis (lazy init)
 _redis_client = None
 
 
-def get_redis() -> redis.Redis:
-    """Obtiene conexión a Redis (lazy init)."""
+def get_redis() -> aioredis.Redis:
+    """Obtiene conexión async a Redis (lazy init)."""
     global _redis_client
     if _redis_client is None:
-        _redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+        _redis_client = aioredis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
     return _redis_client
 
 
-def set_user_language(channel: str, user_id: str, language: str):
+async def set_user_language(channel: str, user_id: str, language: str):
     """Guarda el idioma del usuario en Redis."""
     try:
-        r = get_redis()
         key = f"chat:language:{channel}:{user_id}"
-        r.setex(key, HISTORY_TTL, language)
+        await get_redis().setex(key, HISTORY_TTL, language)
     except Exception as e:
-        print(f"[API] Error guardando idioma en Redis: {e}")
+        log.warning("Error guardando idioma en Redis: %s", e)
+
+
+async def detectar_idioma(texto: str) -> str:
+    """
+    Detecta el idioma del texto con langdetect. Si falla, retorna español.
+
+    El resultado se guarda en Redis por hash del contenido para no repetir
+    la detección en respuestas repetidas.
+    """
+    key = f"lang:{hashlib.sha1(texto.encode()).hexdigest()[:16]}"
+    try:
+        cached = await get_redis().get(key)
+        if cached:
+            return cached
+    except Exception as e:
+        log.warning("Error leyendo idioma de Redis: %s", e)
+
+    try:
+        language = detect(texto)
+    except LangDetectException:
+        return "es"
+
+    try:
+        await get_redis().setex(key, LANGUAGE_CACHE_TTL, language)
+    except Exception as e:
+        log.warning("Error guardando idioma en Redis: %s", e)
+
+    return language
 
 
 # Timeout para llamadas HTTP (5 minutos para LLM)
 TIMEOUT = httpx.Timeout(300.0, connect=30.0)
 
+# Máximo de llamadas simultáneas a LLM Vision (entre todas las requests)
+# Debe coincidir con OLLAMA_NUM_PARALLEL del servicio llm
+LLM_VISION_CONCURRENCY = int(os.getenv("LLM_VISION_CONCURRENCY", "4"))
+llm_vision_sem = asyncio.Semaphore(LLM_VISION_CONCURRENCY)
+
+# PDFs de hasta este número de páginas se analizan en una sola llamada
+# con todas las imágenes (0 desactiva el análisis agrupado)
+MAX_BATCH_PAGES = int(os.getenv("MAX_BATCH_PAGES", "4"))
+
+# Conexiones keep-alive hacia Ollama (igual a OLLAMA_NUM_PARALLEL)
+LLM_CLIENT_POOL_SIZE = int(os.getenv("LLM_CLIENT_POOL_SIZE", "4"))
+
+# Archivos temporales en tmpfs (RAM) si existe, en vez del overlay del contenedor
+TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Clientes HTTP compartidos (se crean en startup, reutilizan conexiones)
+# - _http_client: STT y TTS
+# - _llm_client: Ollama, con pool dimensionado a sus peticiones en paralelo
+_http_client: httpx.AsyncClient | None = None
+_llm_client: httpx.AsyncClient | None = None
+
+
+@app.on_event("startup")
+async def crear_http_client():
+    """Crea los clientes HTTP compartidos por todas las peticiones."""
+    global _http_client, _llm_client
+    _http_client = httpx.AsyncClient(
+        timeout=TIMEOUT,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+    )
+    _llm_client = httpx.AsyncClient(
+        timeout=TIMEOUT,
+        limits=httpx.Limits(
+            max_keepalive_connections=LLM_CLIENT_POOL_SIZE,
+            max_connections=None
+        )
+    )
+
+
+@app.on_event("shutdown")
+async def cerrar_http_client():
+    """Cierra los clientes HTTP compartidos."""
+    for client in (_http_client, _llm_client):
+        if client is not None:
+            await client.aclose()
+
+
+# Cache semántico de respuestas del LLM (desactivado por defecto)
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+LLM_EMBED_MODEL = os.getenv("LLM_EMBED_MODEL", "paraphrase-multilingual")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX = int(os.getenv("SEMANTIC_CACHE_MAX", "1000"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+
+
+class SemanticCache:
+    """
+    Cache en memoria de respuestas del LLM indexado por embedding del prompt.
+
+    Índice plano en un buffer circular de tamaño fijo: la similitud coseno
+    es un producto punto sobre vectores normalizados. Cada entrada pertenece
+    a un namespace (modelo + system prompt) y expira tras `ttl` segundos.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._vectors: np.ndarray | None = None
+        self._namespaces = np.full(max_entries, "", dtype=object)
+        self._expires = np.zeros(max_entries)
+        self._values: list[str | None] = [None] * max_entries
+        self._next = 0
+
+    def get(self, namespace: str, vector: np.ndarray) -> str | None:
+        """Retorna la respuesta más similar si supera el umbral."""
+        if self._vectors is None:
+            return None
+
+        sims = self._vectors @ vector
+        sims[(self._namespaces != namespace) | (self._expires < time.monotonic())] = -1.0
+        i = int(np.argmax(sims))
+        return self._values[i] if sims[i] >= self.threshold else None
+
+    def put(self, namespace: str, vector: np.ndarray, value: str):
+        """Guarda una respuesta, reemplazando la entrada más antigua."""
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+        i = self._next
+        self._vectors[i] = vector
+        self._namespaces[i] = namespace
+        self._expires[i] = time.monotonic() + self.ttl
+        self._values[i] = value
+        self._next = (i + 1) % self.max_entries
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_MAX, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+
+
+def cache_namespace(model: str, system_prompt: str, idioma: str) -> str:
+    """
+    Namespace del cache semántico: respuestas de un modelo, system prompt
+    e idioma.
+
+    El modelo de embeddings es multilingüe ("hola" y "hello" quedan sobre el
+    umbral), así que el idioma separa las entradas para no responder en otro.
+    """
+    return f"{model}:{idioma}:{hashlib.sha1(system_prompt.encode()).hexdigest()[:16]}"
+
+
+async def embed_texto(texto: str) -> np.ndarray | None:
+    """
+    Obtiene el embedding normalizado del texto con Ollama.
+
+    Retorna None si el cache semántico está desactivado o si falla la llamada
+    (en ese caso se consulta al LLM sin cache).
+    """
+    if not SEMANTIC_CACHE:
+        return None
+
+    try:
+        response = await _llm_client.post(
+            f"{LLM_URL}/api/embed",
+            json={"model": LLM_EMBED_MODEL, "input": texto}
+        )
+        response.raise_for_status()
+        vector = np.asarray(response.json()["embeddings"][0], dtype=np.float32)
+    except Exception as e:
+        log.warning("Error obteniendo embedding: %s", e)
+        return None
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
 # Tipos de documento para clasificación
 TIPOS_DOCUMENTO = [
     "CSF",                    # Constancia de Situación Fiscal
@@ -101,6 +291,23 @@ DESCRIPCION: [breve descripción del documento]
 
 Si no puedes identificar el documento, usa "Otro" como tipo."""
 
+# Campos de la respuesta de clasificación ("CAMPO: valor", uno por línea)
+PATRON_CLASIFICACION = re.compile(
+    r"^\s*(TIPO|CONFIANZA|DESCRIPCI[OÓ]N)\s*:\s*(.+?)\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+
+def normalizar_tipo(texto: str) -> str:
+    """Normaliza un tipo de documento: sin acentos, mayúsculas ni corchetes."""
+    sin_acentos = unicodedata.normalize("NFKD", texto)
+    sin_acentos = "".join(c for c in sin_acentos if not unicodedata.combining(c))
+    return sin_acentos.strip(" []*\"'.").casefold()
+
+
+# Tipo normalizado → tipo canónico (tolera acentos omitidos por el LLM)
+TIPOS_DOCUMENTO_NORMALIZADOS = {normalizar_tipo(t): t for t in TIPOS_DOCUMENTO}
+
 
 class ChatRequest(BaseModel):
     texto: str
@@ -128,31 +335,26 @@ class ClassifyResponse(BaseModel):
     idioma: str
 
 
-def wav_to_ogg_base64(wav_bytes: bytes) -> str:
+async def wav_to_ogg_base64(wav_bytes: bytes) -> str:
     """Convierte WAV a OGG Opus y retorna en base64."""
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as wav_file:
-        wav_file.write(wav_bytes)
-        wav_path = wav_file.name
-
-    ogg_path = wav_path.replace(".wav", ".ogg")
-
-    try:
-        subprocess.run([
-            "ffmpeg", "-y", "-i", wav_path,
-            "-c:a", "libopus", "-b:a", "48k",
-            "-application", "voip",
-            ogg_path
-        ], capture_output=True, check=True)
+    # ffmpeg lee el WAV por stdin y escribe el OGG por stdout (sin archivos temporales)
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "wav", "-i", "pipe:0",
+        "-c:a", "libopus", "-b:a", "48k",
+        "-application", "voip",
+        "-f", "ogg", "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=1 << 20  # buffer de 1 MB para leer el OGG sin pausas
+    )
+    ogg_bytes, stderr = await proc.communicate(input=wav_bytes)
 
-        with open(ogg_path, "rb") as f:
-            ogg_bytes = f.read()
+    if proc.returncode != 0:
+        raise Exception(f"Error convirtiendo WAV a OGG: {stderr.decode()}")
 
-        return base64.b64encode(ogg_bytes).decode("utf-8")
-    finally:
-        if os.path.exists(wav_path):
-            os.unlink(wav_path)
-        if os.path.exists(ogg_path):
-            os.unlink(ogg_path)
+    return base64.b64encode(ogg_bytes).decode("utf-8")
 
 
 def image_to_base64(image_bytes: bytes) -> str:
@@ -160,48 +362,84 @@ def image_to_base64(image_bytes: bytes) -> str:
     return base64.b64encode(image_bytes).decode("utf-8")
 
 
-def pdf_to_images(pdf_bytes: bytes) -> list[bytes]:
-    """Convierte PDF a lista de imágenes (una por página)."""
-    images = convert_from_bytes(pdf_bytes, dpi=150)
+def pdf_to_images(
+    pdf_bytes: bytes,
+    first_page: int | None = None,
+    last_page: int | None = None
+) -> list[bytes]:
+    """
+    Convierte PDF a lista de imágenes JPEG (una por página).
+
+    first_page/last_page limitan las páginas que se rasterizan.
+    """
+    from pdf2image import convert_from_bytes
+
+    images = convert_from_bytes(
+        pdf_bytes, dpi=150, first_page=first_page, last_page=last_page
+    )
     result = []
     for img in images:
         buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
+        # JPEG es mucho más ligero que PNG y suficiente para el modelo de visión
+        img.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
         result.append(buffer.getvalue())
     return result
 
 
+def pdf_to_images_base64(
+    pdf_bytes: bytes,
+    first_page: int | None = None,
+    last_page: int | None = None
+) -> list[str]:
+    """Convierte PDF a imágenes JPEG en base64, listas para LLM Vision."""
+    return [image_to_base64(img) for img in pdf_to_images(pdf_bytes, first_page, last_page)]
+
+
+# Firmas (magic bytes) de los tipos reconocidos, por longitud del prefijo
+FIRMAS_ARCHIVO = {
+    b'\x89PNG\r\n\x1a\n': "png",
+    b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1': "doc",  # Office antiguo (OLE2): doc, xls, ppt
+    b'%PDF': "pdf",
+    b'GIF8': "gif",
+    b'\xff\xd8': "jpeg",
+}
+
+# Carpeta interna del ZIP que identifica cada formato Office
+CARPETAS_OFFICE = (("word/", "docx"), ("xl/", "xlsx"), ("ppt/", "pptx"))
+
+
+def detect_office_zip(file_bytes: bytes) -> str:
+    """Identifica un ZIP de Office leyendo su directorio central."""
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+            nombres = zf.namelist()
+    except zipfile.BadZipFile:
+        return "zip"
+
+    for carpeta, tipo in CARPETAS_OFFICE:
+        if any(nombre.startswith(carpeta) for nombre in nombres):
+            return tipo
+    return "zip"
+
+
 def detect_file_type(file_bytes: bytes) -> str:
     """Detecta el tipo de archivo por magic bytes."""
-    if file_bytes[:4] == b'%PDF':
-        return "pdf"
-    elif file_bytes[:8] == b'\x89PNG\r\n\x1a\n':
-        return "png"
-    elif file_bytes[:2] == b'\xff\xd8':
-        return "jpeg"
-    elif file_bytes[:4] == b'GIF8':
-        return "gif"
-    elif file_bytes[:4] == b'RIFF' and file_bytes[8:12] == b'WEBP':
+    header = bytes(file_bytes[:12])
+
+    for n in (8, 4, 2):
+        tipo = FIRMAS_ARCHIVO.get(header[:n])
+        if tipo:
+            return tipo
+
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
         return "webp"
     # Archivos Office (ZIP con estructura específica)
-    elif file_bytes[:4] == b'PK\x03\x04':
-        # Es un archivo ZIP, verificar si es Office
-        if b'word/' in file_bytes[:2000]:
-            return "docx"
-        elif b'xl/' in file_bytes[:2000]:
-            return "xlsx"
-        elif b'ppt/' in file_bytes[:2000]:
-            return "pptx"
-        else:
-            return "zip"
-    # Archivos Office antiguos (OLE2)
-    elif file_bytes[:8] == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
-        return "doc"  # Puede ser doc, xls, ppt
-    else:
-        return "unknown"
+    if header[:4] == b'PK\x03\x04':
+        return detect_office_zip(file_bytes)
+    return "unknown"
 
 
-def office_to_pdf(file_bytes: bytes, file_type: str) -> bytes:
+async def office_to_pdf(file_bytes: bytes, file_type: str) -> bytes:
     """Convierte archivo Office a PDF usando LibreOffice."""
     # Mapear extensiones
     extensions = {
@@ -211,115 +449,238 @@ def office_to_pdf(file_bytes: bytes, file_type: str) -> bytes:
     }
     ext = extensions.get(file_type, ".docx")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
+    with tempfile.TemporaryDirectory(dir=TMP_DIR) as tmpdir:
         # Guardar archivo original
-        input_path = os.path.join(tmpdir, f"input{ext}")
-        with open(input_path, "wb") as f:
-            f.write(file_bytes)
+        input_path = Path(tmpdir) / f"input{ext}"
+        input_path.write_bytes(file_bytes)
 
         # Convertir a PDF con LibreOffice
-        result = subprocess.run([
-            "libreoffice", "--headless", "--convert-to", "pdf",
-            "--outdir", tmpdir, input_path
-        ], capture_output=True, timeout=120)
-
-        if result.returncode != 0:
-            raise Exception(f"Error convirtiendo Office a PDF: {result.stderr.decode()}")
-
-        # Leer PDF generado
-        pdf_path = os.path.join(tmpdir, "input.pdf")
-        if not os.path.exists(pdf_path):
+        # Perfil propio por conversión: con el perfil compartido, un soffice
+        # concurrente delega el trabajo al primero y sale sin generar el PDF
+        perfil = (Path(tmpdir) / "lo_profile").as_uri()
+        proc = await asyncio.create_subprocess_exec(
+            "libreoffice", f"-env:UserInstallation={perfil}",
+            "--headless", "--convert-to", "pdf",
+            "--outdir", tmpdir, str(input_path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=120)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise Exception("Timeout convirtiendo Office a PDF")
+
+        if proc.returncode != 0:
+            raise Exception(f"Error convirtiendo Office a PDF: {stderr.decode()}")
+
+        # Leer PDF generado (sin stat previo: open falla si no existe)
+        try:
+            return (Path(tmpdir) / "input.pdf").read_bytes()
+        except FileNotFoundError:
             raise Exception("No se generó el PDF")
 
-        with open(pdf_path, "rb") as f:
-            return f.read()
-
 
 async def call_stt(audio_bytes: bytes, filename: str = "audio.ogg") -> dict:
     """Llama al servicio STT para transcribir audio."""
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        files = {"audio": (filename, audio_bytes)}
-        response = await client.post(f"{STT_URL}/transcribe", files=files)
+    files = {"audio": (filename, audio_bytes)}
+    response = await _http_client.post(f"{STT_URL}/transcribe", files=files)
 
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error en STT: {response.text}"
-            )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error en STT: {response.text}"
+        )
+
+    return response.json()
+
+
+# Fin de oración: el texto hasta aquí se puede sintetizar
+# Exige un espacio después: en el buffer parcial del stream, un "3." o
+# "www." al final todavía puede continuar ("3.5", "www.ejemplo.com").
+# El final del stream se sintetiza aparte con lo pendiente
+FIN_ORACION = re.compile(r"[.!?;:](?=\s)|\n")
+
+# Mínimo de caracteres por llamada a TTS (evita fragmentos muy cortos)
+MIN_CARACTERES_TTS = 40
+
+
+def cortar_oraciones(texto: str) -> tuple[str, str]:
+    """Separa las oraciones completas del texto aún pendiente."""
+    fin = 0
+    for match in FIN_ORACION.finditer(texto):
+        fin = match.end()
+    return texto[:fin], texto[fin:]
 
-        return response.json()
 
+def concatenar_wavs(wavs: list[bytes]) -> bytes:
+    """Une varios WAV con el mismo formato en uno solo."""
+    if len(wavs) <= 1:
+        return wavs[0] if wavs else b""
 
-async def call_llm(texto: str, system_prompt: str | None = None) -> str:
-    """Llama al servicio LLM para generar respuesta."""
+    salida = io.BytesIO()
+    with wave.open(salida, "wb") as out:
+        for i, wav_bytes in enumerate(wavs):
+            with wave.open(io.BytesIO(wav_bytes), "rb") as w:
+                if i == 0:
+                    out.setparams(w.getparams())
+                out.writeframes(w.readframes(w.getnframes()))
+    return salida.getvalue()
+
+
+async def stream_llm_tts(payload: dict, idioma: str, servicio: str = "LLM") -> tuple[str, bytes]:
+    """
+    Llama al LLM en modo streaming y sintetiza cada oración en cuanto termina.
+
+    La síntesis de audio se solapa con la generación del texto.
+    Retorna el texto completo y el WAV de todas las oraciones concatenadas.
+    """
+    partes = []
+    pendiente = ""
+    tareas: list[asyncio.Task] = []
+
+    try:
+        async with _llm_client.stream(
+            "POST", f"{LLM_URL}/api/chat", json={**payload, "stream": True}
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Error en {servicio}: {response.text}"
+                )
+
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Error en {servicio}: {chunk['error']}"
+                    )
+
+                delta = chunk.get("message", {}).get("content", "")
+                partes.append(delta)
+                pendiente += delta
+
+                # Enviar a TTS las oraciones completas
+                completas, resto = cortar_oraciones(pendiente)
+                if len(completas.strip()) >= MIN_CARACTERES_TTS:
+                    tareas.append(asyncio.create_task(call_tts(completas.strip(), idioma)))
+                    pendiente = resto
+
+        if pendiente.strip():
+            tareas.append(asyncio.create_task(call_tts(pendiente.strip(), idioma)))
+
+        wavs = await asyncio.gather(*tareas)
+    except BaseException:
+        for tarea in tareas:
+            tarea.cancel()
+        raise
+
+    return "".join(partes), concatenar_wavs(list(wavs))
+
+
+async def call_llm_tts(
+    texto: str,
+    idioma: str = "es",
+    system_prompt: str | None = None
+) -> tuple[str, bytes]:
+    """Llama al servicio LLM y sintetiza la respuesta. Retorna (texto, WAV)."""
     prompt = system_prompt or SYSTEM_PROMPT
 
+    # Buscar una respuesta previa a un mensaje similar
+    namespace = cache_namespace(LLM_MODEL, prompt, idioma)
+    vector = await embed_texto(texto)
+    if vector is not None:
+        cached = semantic_cache.get(namespace, vector)
+        if cached:
+            return cached, await call_tts(cached, idioma)
+
     payload = {
         "model": LLM_MODEL,
         "messages": [
             {"role": "system", "content": prompt},
             {"role": "user", "content": texto}
-        ],
-        "stream": False
+        ]
     }
 
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        response = await client.post(f"{LLM_URL}/api/chat", json=payload)
+    content, wav_bytes = await stream_llm_tts(payload, idioma)
 
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error en LLM: {response.text}"
-            )
+    if vector is not None and content:
+        semantic_cache.put(namespace, vector, content)
 
-        data = response.json()
-        return data.get("message", {}).get("content", "")
+    return content, wav_bytes
 
 
-async def call_llm_vision(
-    image_b64: str,
-    prompt: str = "Describe esta imagen en detalle.",
+def payload_vision(
+    image_b64: str | list[str],
+    prompt: str,
     system_prompt: str | None = None
-) -> str:
-    """Llama al servicio LLM con modelo de visión para analizar imagen."""
+) -> dict:
+    """Arma el payload de Ollama para el modelo de visión."""
+    images = image_b64 if isinstance(image_b64, list) else [image_b64]
     sys_prompt = system_prompt or "Eres un asistente experto en análisis de imágenes y documentos."
 
-    payload = {
+    return {
         "model": LLM_IMG_MODEL,
         "messages": [
             {"role": "system", "content": sys_prompt},
-            {"role": "user", "content": prompt, "images": [image_b64]}
-        ],
-        "stream": False
+            {"role": "user", "content": prompt, "images": images}
+        ]
     }
 
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        response = await client.post(f"{LLM_URL}/api/chat", json=payload)
 
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error en LLM Vision: {response.text}"
-            )
+async def call_llm_vision(
+    image_b64: str | list[str],
+    prompt: str = "Describe esta imagen en detalle.",
+    system_prompt: str | None = None
+) -> str:
+    """
+    Llama al servicio LLM con modelo de visión para analizar imagen.
 
-        data = response.json()
-        return data.get("message", {}).get("content", "")
+    Acepta una imagen o una lista de imágenes (se envían en el mismo mensaje).
+    """
+    payload = {**payload_vision(image_b64, prompt, system_prompt), "stream": False}
+
+    async with llm_vision_sem:
+        response = await _llm_client.post(f"{LLM_URL}/api/chat", json=payload)
+
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error en LLM Vision: {response.text}"
+        )
+
+    data = response.json()
+    return data.get("message", {}).get("content", "")
+
+
+async def call_llm_vision_tts(
+    image_b64: str,
+    prompt: str,
+    idioma: str = "es"
+) -> tuple[str, bytes]:
+    """Analiza la imagen con LLM Vision y sintetiza la respuesta. Retorna (texto, WAV)."""
+    async with llm_vision_sem:
+        return await stream_llm_tts(payload_vision(image_b64, prompt), idioma, "LLM Vision")
 
 
 async def call_tts(texto: str, idioma: str = "es") -> bytes:
     """Llama al servicio TTS para sintetizar audio."""
     payload = {"texto": texto, "idioma": idioma}
 
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        response = await client.post(f"{TTS_URL}/synthesize", json=payload)
+    response = await _http_client.post(f"{TTS_URL}/synthesize", json=payload)
 
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error en TTS: {response.text}"
-            )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error en TTS: {response.text}"
+        )
 
-        return response.content
+    return response.content
 
 
 def parse_clasificacion(texto: str) -> tuple[str, str, str]:
@@ -328,19 +689,17 @@ def parse_clasificacion(texto: str) -> tuple[str, str, str]:
     confianza = "baja"
     descripcion = texto
 
-    lines = texto.strip().split("\n")
-    for line in lines:
-        line_upper = line.upper()
-        if line_upper.startswith("TIPO:"):
-            tipo = line.split(":", 1)[1].strip()
-        elif line_upper.startswith("CONFIANZA:"):
-            confianza = line.split(":", 1)[1].strip().lower()
-        elif line_upper.startswith("DESCRIPCION:") or line_upper.startswith("DESCRIPCIÓN:"):
-            descripcion = line.split(":", 1)[1].strip()
+    for match in PATRON_CLASIFICACION.finditer(texto):
+        campo, valor = match.group(1).upper(), match.group(2)
+        if campo == "TIPO":
+            tipo = valor
+        elif campo == "CONFIANZA":
+            confianza = valor.lower()
+        else:
+            descripcion = valor
 
     # Validar tipo
-    if tipo not in TIPOS_DOCUMENTO:
-        tipo = "Otro"
+    tipo = TIPOS_DOCUMENTO_NORMALIZADOS.get(normalizar_tipo(tipo), "Otro")
 
     return tipo, confianza, descripcion
 
@@ -376,13 +735,14 @@ async def chat(request: ChatRequest):
     idioma = request.idioma or "es"
 
     try:
-        respuesta_texto = await call_llm(request.texto, request.system_prompt)
+        respuesta_texto, wav_bytes = await call_llm_tts(
+            request.texto, idioma, request.system_prompt
+        )
 
         if not respuesta_texto:
             raise HTTPException(status_code=500, detail="LLM no generó respuesta")
 
-        wav_bytes = await call_tts(respuesta_texto, idioma)
-        audio_b64 = wav_to_ogg_base64(wav_bytes)
+        audio_b64 = await wav_to_ogg_base64(wav_bytes)
 
         return ChatResponse(
             texto=respuesta_texto,
@@ -417,13 +777,12 @@ async def voice(audio: UploadFile = File(...)):
         if not texto_usuario:
             raise HTTPException(status_code=400, detail="No se pudo transcribir el audio")
 
-        respuesta_texto = await call_llm(texto_usuario)
+        respuesta_texto, wav_bytes = await call_llm_tts(texto_usuario, idioma)
 
         if not respuesta_texto:
             raise HTTPException(status_code=500, detail="LLM no generó respuesta")
 
-        wav_bytes = await call_tts(respuesta_texto, idioma)
-        audio_b64 = wav_to_ogg_base64(wav_bytes)
+        audio_b64 = await wav_to_ogg_base64(wav_bytes)
 
         return ChatResponse(
             texto=respuesta_texto,
@@ -455,13 +814,12 @@ async def image(
 
         image_b64 = image_to_base64(image_bytes)
 
-        respuesta_texto = await call_llm_vision(image_b64, prompt)
+        respuesta_texto, wav_bytes = await call_llm_vision_tts(image_b64, prompt, idioma)
 
         if not respuesta_texto:
             raise HTTPException(status_code=500, detail="LLM Vision no generó respuesta")
 
-        wav_bytes = await call_tts(respuesta_texto, idioma)
-        audio_b64 = wav_to_ogg_base64(wav_bytes)
+        audio_b64 = await wav_to_ogg_base64(wav_bytes)
 
         return ChatResponse(
             texto=respuesta_texto,
@@ -496,31 +854,46 @@ async def document(
         if not file_bytes:
             raise HTTPException(status_code=400, detail="Archivo vacío")
 
-        file_type = detect_file_type(file_bytes)
+        file_type = await asyncio.to_thread(detect_file_type, file_bytes)
 
         # Si es archivo Office, convertir a PDF primero
         if file_type in ("docx", "doc", "xlsx", "xls", "pptx", "ppt"):
-            file_bytes = office_to_pdf(file_bytes, file_type)
+            file_bytes = await office_to_pdf(file_bytes, file_type)
             file_type = "pdf"
 
         if file_type == "pdf":
-            # Convertir PDF a imágenes y analizar cada página
-            images = pdf_to_images(file_bytes)
-            if not images:
+            # Convertir PDF a imágenes base64 (cada página se codifica una sola vez)
+            images_b64 = await asyncio.to_thread(pdf_to_images_base64, file_bytes)
+            if not images_b64:
                 raise HTTPException(status_code=400, detail="No se pudieron extraer páginas del PDF")
 
-            resultados = []
-            for i, img_bytes in enumerate(images):
-                image_b64 = image_to_base64(img_bytes)
-                page_prompt = f"Página {i+1}: {prompt}"
-                resultado = await call_llm_vision(image_b64, page_prompt)
-                resultados.append(f"--- Página {i+1} ---\n{resultado}")
-
-            respuesta_texto = "\n\n".join(resultados)
+            if len(images_b64) <= MAX_BATCH_PAGES:
+                # Documento corto: una sola llamada con todas las páginas
+                batch_prompt = (
+                    f"El documento tiene {len(images_b64)} página(s), "
+                    f"una imagen por página en orden. {prompt}"
+                )
+                respuesta_texto = await call_llm_vision(images_b64, batch_prompt)
+
+            else:
+                # Analizar páginas en paralelo (gather conserva el orden);
+                # llm_vision_sem limita las llamadas simultáneas a Ollama
+                async def analizar_pagina(i: int, image_b64: str) -> str:
+                    page_prompt = f"Página {i+1}: {prompt}"
+                    return await call_llm_vision(image_b64, page_prompt)
+
+                resultados = await asyncio.gather(
+                    *(analizar_pagina(i, image_b64) for i, image_b64 in enumerate(images_b64))
+                )
+
+                respuesta_texto = "\n\n".join(
+                    f"--- Página {i+1} ---\n{resultado}"
+                    for i, resultado in enumerate(resultados)
+                )
 
         elif file_type in ("png", "jpeg", "gif", "webp"):
             # Es una imagen, analizar directamente
-            image_b64 = image_to_base64(file_bytes)
+            image_b64 = await asyncio.to_thread(image_to_base64, file_bytes)
             respuesta_texto = await call_llm_vision(image_b64, prompt)
 
         else:
@@ -533,7 +906,7 @@ async def document(
             raise HTTPException(status_code=500, detail="LLM Vision no generó respuesta")
 
         wav_bytes = await call_tts(respuesta_texto, idioma)
-        audio_b64 = wav_to_ogg_base64(wav_bytes)
+        audio_b64 = await wav_to_ogg_base64(wav_bytes)
 
         return ChatResponse(
             texto=respuesta_texto,
@@ -579,22 +952,24 @@ async def classify(
         if not file_bytes:
             raise HTTPException(status_code=400, detail="Archivo vacío")
 
-        file_type = detect_file_type(file_bytes)
+        file_type = await asyncio.to_thread(detect_file_type, file_bytes)
 
         # Si es archivo Office, convertir a PDF primero
         if file_type in ("docx", "doc", "xlsx", "xls", "pptx", "ppt"):
-            file_bytes = office_to_pdf(file_bytes, file_type)
+            file_bytes = await office_to_pdf(file_bytes, file_type)
             file_type = "pdf"
 
         if file_type == "pdf":
-            # Para clasificación, solo analizamos la primera página
-            images = pdf_to_images(file_bytes)
-            if not images:
+            # Para clasificación, solo rasterizamos la primera página
+            images_b64 = await asyncio.to_thread(
+                pdf_to_images_base64, file_bytes, first_page=1, last_page=1
+            )
+            if not images_b64:
                 raise HTTPException(status_code=400, detail="No se pudieron extraer páginas del PDF")
-            image_b64 = image_to_base64(images[0])
+            image_b64 = images_b64[0]
 
         elif file_type in ("png", "jpeg", "gif", "webp"):
-            image_b64 = image_to_base64(file_bytes)
+            image_b64 = await asyncio.to_thread(image_to_base64, file_bytes)
 
         else:
             raise HTTPException(
@@ -614,7 +989,7 @@ async def classify(
         texto_audio = f"Documento identificado como {tipo}. {descripcion}"
 
         wav_bytes = await call_tts(texto_audio, idioma)
-        audio_b64 = wav_to_ogg_base64(wav_bytes)
+        audio_b64 = await wav_to_ogg_base64(wav_bytes)
 
         return ClassifyResponse(
             tipo_documento=tipo,
@@ -673,17 +1048,35 @@ class LLMChatResponse(BaseModel):
 @app.post("/llm_chat", response_model=LLMChatResponse)
 async def llm_chat(request: LLMChatRequest):
     """Chat con LLM + detección de idioma usando langdetect."""
-    from langdetect import detect, LangDetectException
+    # Cache semántico solo para el primer turno (sin respuestas previas):
+    # con historial, la misma pregunta puede requerir otra respuesta
+    vector = None
+    last = request.messages[-1] if request.messages else {}
+    if (
+        last.get("role") == "user"
+        and isinstance(last.get("content"), str)
+        and not any(m.get("role") == "assistant" for m in request.messages)
+    ):
+        system = "\n".join(
+            str(m.get("content", "")) for m in request.messages if m.get("role") == "system"
+        )
+        namespace = cache_namespace(
+            request.model, system, await detectar_idioma(last["content"])
+        )
+        vector = await embed_texto(last["content"])
 
-    # Llamar a Ollama /api/chat sin modificar los mensajes
-    payload = {
-        "model": request.model,
-        "messages": request.messages,
-        "stream": False
-    }
+    cached = semantic_cache.get(namespace, vector) if vector is not None else None
+    if cached:
+        data = {"model": request.model, "message": {"role": "assistant", "content": cached}}
+    else:
+        # Llamar a Ollama /api/chat sin modificar los mensajes
+        payload = {
+            "model": request.model,
+            "messages": request.messages,
+            "stream": False
+        }
 
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        response = await client.post(f"{LLM_URL}/api/chat", json=payload)
+        response = await _llm_client.post(f"{LLM_URL}/api/chat", json=payload)
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail=f"Error en LLM: {response.text}")
         data = response.json()
@@ -691,16 +1084,16 @@ async def llm_chat(request: LLMChatRequest):
     # Extraer content
     content = data.get("message", {}).get("content", "").strip()
 
+    if vector is not None and content and not cached:
+        semantic_cache.put(namespace, vector, content)
+
     # Detectar idioma con langdetect
-    try:
-        language = detect(content) if content else "es"
-    except LangDetectException:
-        language = "es"
+    language = await detectar_idioma(content) if content else "es"
 
-    print(f"[API] LLM response language detected: {language}")
+    log.debug("LLM response language detected: %s", language)
 
     # Guardar idioma en Redis
-    set_user_language(request.channel, request.user_id, language)
+    await set_user_language(request.channel, request.user_id, language)
 
     # Retornar misma estructura de Ollama + language
     return LLMChatResponse(
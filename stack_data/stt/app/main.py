@@ -1,23 +1,101 @@
 """
 Servicio STT - Speech to Text con Whisper
+
+Backends (WHISPER_BACKEND):
+- faster-whisper: CTranslate2 con cuantización INT8 (default, más rápido)
+- openai: implementación original de OpenAI sobre PyTorch
 """
 import os
+import asyncio
+import hashlib
+import logging
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-import whisper
+
+# Logging (nivel configurable con LOG_LEVEL)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="[STT] %(levelname)s %(message)s"
+)
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="STT Service",
-    description="Servicio de transcripción de voz a texto con Whisper"
+    description="Servicio de transcripción de voz a texto con Whisper",
+    default_response_class=ORJSONResponse
 )
 
 # Configuración del modelo
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small")
 
+# Backend de inferencia: "faster-whisper" u "openai"
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "faster-whisper")
+
+# Dispositivo: "auto" usa GPU (CUDA) si está disponible
+# Se resuelve al cargar el modelo (los backends se importan de forma diferida)
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "auto")
+
+# Tipo de cómputo de faster-whisper (vacío = int8_float16 en GPU, int8 en CPU)
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "")
+
+# FP16 solo en GPU (backend openai; en CPU usa FP32)
+WHISPER_FP16 = False
+
+# Compilar el encoder con torch.compile (backend openai)
+# El cache de Inductor se guarda en TORCHINDUCTOR_CACHE_DIR para que
+# otras réplicas y reinicios no recompilen
+WHISPER_COMPILE = os.getenv("WHISPER_COMPILE", "false").lower() == "true"
+
+# Descartar audio sin voz antes de transcribir (backend openai)
+# Usa el Silero VAD incluido en faster-whisper (ONNX, sin descargas)
+WHISPER_VAD = os.getenv("WHISPER_VAD", "true").lower() == "true"
+
+# Umbrales de silencio de Whisper: un segmento es silencio si la
+# probabilidad de "no habla" supera NO_SPEECH_THRESHOLD y el logprob
+# promedio queda bajo LOGPROB_THRESHOLD (mismo criterio que transcribe)
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+
+# Frecuencia de muestreo esperada por Whisper
+SAMPLE_RATE = 16000
+
+# Tamaño de bloque al leer uploads (64 KB)
+CHUNK_UPLOAD = 1 << 16
+
+# Temporales en tmpfs (RAM) si existe
+TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
 # Modelo cargado
 modelo = None
 
+# Serializa el uso del modelo (una inferencia a la vez por instancia)
+modelo_lock = asyncio.Semaphore(1)
+
+# Hilo único para cargar, precalentar y usar el modelo: los CUDA graphs de
+# torch.compile (mode="reduce-overhead") son por hilo, así que se graban
+# una sola vez en el precalentamiento y se reutilizan en cada request
+MODELO_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+
+
+async def en_hilo_modelo(funcion, *args):
+    """Ejecuta `funcion` en el hilo del modelo sin bloquear el event loop."""
+    return await asyncio.get_running_loop().run_in_executor(MODELO_EXEC, funcion, *args)
+
+# Micro-batching (backend openai): las requests que llegan dentro de la
+# ventana se transcriben juntas con una sola pasada del encoder.
+# STT_BATCH_SIZE=1 lo desactiva
+STT_BATCH_SIZE = int(os.getenv("STT_BATCH_SIZE", "8"))
+STT_BATCH_WINDOW_MS = int(os.getenv("STT_BATCH_WINDOW_MS", "30"))
+
+# Cola de (audio, future) pendientes y tarea que la consume
+cola_batch: asyncio.Queue | None = None
+tarea_batcher: asyncio.Task | None = None
+
 
 class TranscripcionResponse(BaseModel):
     texto: str
@@ -25,20 +103,385 @@ class TranscripcionResponse(BaseModel):
     confianza: float
 
 
+# Cache de transcripciones por hash del audio (reintentos, webhooks duplicados)
+STT_CACHE_SIZE = int(os.getenv("STT_CACHE_SIZE", "512"))
+transcripciones_cache: OrderedDict[str, TranscripcionResponse] = OrderedDict()
+
+
 def cargar_modelo():
-    """Carga el modelo Whisper."""
-    global modelo
+    """Carga el modelo Whisper con el backend configurado."""
+    global modelo, WHISPER_DEVICE, WHISPER_FP16
     if modelo is None:
-        print(f"[STT] Cargando modelo Whisper: {WHISPER_MODEL}")
-        modelo = whisper.load_model(WHISPER_MODEL)
-        print(f"[STT] Modelo cargado correctamente")
+        if WHISPER_BACKEND == "faster-whisper":
+            # Imports pesados solo al cargar el modelo
+            import ctranslate2
+            from faster_whisper import WhisperModel
+
+            if WHISPER_DEVICE == "auto":
+                WHISPER_DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+            compute_type = WHISPER_COMPUTE_TYPE or (
+                "int8_float16" if WHISPER_DEVICE == "cuda" else "int8"
+            )
+
+            log.info("Cargando modelo faster-whisper: %s (%s, %s)", WHISPER_MODEL, WHISPER_DEVICE, compute_type)
+            modelo = WhisperModel(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=compute_type)
+        else:
+            # Imports pesados (torch) solo al cargar el modelo
+            import torch
+            import whisper
+
+            if WHISPER_DEVICE == "auto":
+                WHISPER_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+            WHISPER_FP16 = WHISPER_DEVICE == "cuda"
+
+            log.info("Cargando modelo Whisper: %s (%s)", WHISPER_MODEL, WHISPER_DEVICE)
+            modelo = whisper.load_model(WHISPER_MODEL, device=WHISPER_DEVICE)
+            if WHISPER_COMPILE:
+                compilar_encoder(modelo)
+        log.info("Modelo cargado correctamente")
     return modelo
 
 
+def compilar_encoder(modelo):
+    """
+    Compila el encoder de Whisper con torch.compile y lo precalienta.
+
+    Cada clip es un mel de tamaño fijo (n_mels × 3000), pero el
+    micro-batching llama al encoder con lotes de 1 a STT_BATCH_SIZE clips y
+    con dynamic=False cada tamaño de lote es un grafo (y en GPU un CUDA graph
+    de mode="reduce-overhead") distinto. Se precalientan todos los tamaños
+    al iniciar para no recompilar dentro de una request.
+    """
+    import torch
+    import torch._inductor.config
+
+    # Reutilizar grafos compilados guardados en disco
+    torch._inductor.config.fx_graph_cache = True
+
+    mode = "reduce-overhead" if WHISPER_DEVICE == "cuda" else "default"
+    log.info("Compilando encoder (mode=%s)", mode)
+    modelo.encoder = torch.compile(modelo.encoder, mode=mode, dynamic=False)
+
+    # Precalentar con 30 s de silencio para compilar al iniciar
+    silencio = np.zeros(SAMPLE_RATE * 30, dtype=np.float32)
+    with torch.inference_mode():
+        modelo.transcribe(silencio, fp16=WHISPER_FP16)
+
+        # Tamaños de lote del micro-batching (el de 1 ya quedó compilado)
+        dtype = torch.float16 if WHISPER_FP16 else torch.float32
+        for n in range(2, STT_BATCH_SIZE + 1):
+            mels = torch.zeros(
+                (n, modelo.dims.n_mels, 3000), dtype=dtype, device=modelo.device
+            )
+            modelo.encoder(mels)
+
+
+def hay_voz(audio_data: np.ndarray) -> bool:
+    """Indica si el audio contiene voz según Silero VAD (~ms por clip)."""
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    return bool(get_speech_timestamps(audio_data, VadOptions()))
+
+
+def audio_a_dispositivo(audio_data: np.ndarray, modelo):
+    """
+    Copia el audio al dispositivo del modelo (backend openai).
+
+    En CUDA la copia sale de memoria pinned y es asíncrona: el mel que se
+    calcula después corre en el mismo stream, así que no hace falta
+    sincronizar.
+    """
+    import torch
+
+    audio_t = torch.from_numpy(audio_data)
+    if modelo.device.type == "cuda":
+        return audio_t.pin_memory().to(modelo.device, non_blocking=True)
+    return audio_t.to(modelo.device)
+
+
+def transcribir_audio(audio_data: np.ndarray) -> tuple[str, str, float]:
+    """
+    Transcribe el audio con el backend configurado.
+
+    Retorna (texto, idioma, confianza del idioma). Es bloqueante: se
+    ejecuta en MODELO_EXEC.
+    """
+    modelo = cargar_modelo()
+
+    if WHISPER_BACKEND == "faster-whisper":
+        # segments es un generador: la decodificación ocurre al recorrerlo
+        # Greedy a temperatura fija y sin condicionar en el texto previo:
+        # menos trabajo del decoder y menos alucinaciones en silencios
+        segments, info = modelo.transcribe(
+            audio_data,
+            beam_size=1,
+            best_of=1,
+            temperature=0.0,
+            condition_on_previous_text=False,
+            no_speech_threshold=NO_SPEECH_THRESHOLD,
+            log_prob_threshold=LOGPROB_THRESHOLD,
+            vad_filter=True
+        )
+        texto = "".join(seg.text for seg in segments).strip()
+        return texto, info.language, info.language_probability
+
+    import torch
+
+    # inference_mode evita el tracking de vistas y versiones de no_grad
+    with torch.inference_mode():
+        resultado = modelo.transcribe(
+            audio_data,
+            fp16=WHISPER_FP16,
+            beam_size=None,
+            temperature=0.0,
+            condition_on_previous_text=False,
+            no_speech_threshold=NO_SPEECH_THRESHOLD,
+            logprob_threshold=LOGPROB_THRESHOLD
+        )
+    return (
+        resultado["text"].strip(),
+        resultado["language"],
+        resultado.get("language_probability", 0.0)
+    )
+
+
+def transcribir_lote(audios: list[np.ndarray]) -> list[tuple[str, str, float]]:
+    """
+    Transcribe varios clips de hasta 30 s en un solo batch (backend openai).
+
+    Whisper siempre recibe un mel de 30 s (n_mels × 3000), así que los mels
+    se apilan sin padding adicional: el encoder corre una vez para todo el
+    lote y el decoder avanza todos los clips en paralelo. Es bloqueante: se
+    ejecuta en MODELO_EXEC.
+
+    whisper.decode no descarta silencios: se aplica el mismo criterio que
+    transcribe (temperatura fija 0, sin fallback) para que un clip dé el
+    mismo resultado con o sin batch.
+    """
+    import torch
+    import whisper
+
+    modelo = cargar_modelo()
+
+    with torch.inference_mode():
+        mels = torch.stack([
+            whisper.log_mel_spectrogram(
+                whisper.pad_or_trim(audio_a_dispositivo(audio, modelo)),
+                modelo.dims.n_mels
+            )
+            for audio in audios
+        ])
+        opciones = whisper.DecodingOptions(fp16=WHISPER_FP16, without_timestamps=True)
+        resultados = whisper.decode(modelo, mels, opciones)
+
+    return [
+        (
+            "" if es_silencio(r.no_speech_prob, r.avg_logprob) else r.text.strip(),
+            r.language,
+            (r.language_probs or {}).get(r.language, 0.0)
+        )
+        for r in resultados
+    ]
+
+
+def es_silencio(no_speech_prob: float, avg_logprob: float) -> bool:
+    """Indica si un resultado de Whisper es silencio (criterio de transcribe)."""
+    return no_speech_prob > NO_SPEECH_THRESHOLD and avg_logprob < LOGPROB_THRESHOLD
+
+
+async def batcher():
+    """
+    Agrupa las transcripciones pendientes y las procesa por lotes.
+
+    Espera la primera request y junta las que lleguen en los siguientes
+    STT_BATCH_WINDOW_MS (hasta STT_BATCH_SIZE).
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        lote = [await cola_batch.get()]
+        limite = loop.time() + STT_BATCH_WINDOW_MS / 1000
+        while len(lote) < STT_BATCH_SIZE:
+            restante = limite - loop.time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(cola_batch.get(), restante))
+            except asyncio.TimeoutError:
+                break
+
+        # Descartar requests que el cliente ya abandonó
+        lote = [(audio, futuro) for audio, futuro in lote if not futuro.done()]
+        if not lote:
+            continue
+
+        try:
+            async with modelo_lock:
+                resultados = await en_hilo_modelo(
+                    transcribir_lote, [audio for audio, _ in lote]
+                )
+        except Exception as e:
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            continue
+
+        if len(lote) > 1:
+            log.debug("Lote de %d transcripciones", len(lote))
+        for (_, futuro), resultado in zip(lote, resultados):
+            if not futuro.done():
+                futuro.set_result(resultado)
+
+
+def detectar_idioma_audio(audio_data: np.ndarray) -> dict[str, float]:
+    """
+    Detecta el idioma de los primeros 30 segundos del audio.
+
+    Retorna las probabilidades por idioma. Es bloqueante: se ejecuta en MODELO_EXEC.
+    """
+    modelo = cargar_modelo()
+
+    if WHISPER_BACKEND == "faster-whisper":
+        _, _, probs = modelo.detect_language(audio_data)
+        return dict(probs)
+
+    import torch
+    import whisper
+
+    # Copiar al dispositivo solo los primeros 30 s y calcular el mel ahí
+    # (la STFT corre en GPU cuando hay CUDA)
+    with torch.inference_mode():
+        audio_t = whisper.pad_or_trim(
+            audio_a_dispositivo(audio_data[:SAMPLE_RATE * 30], modelo)
+        )
+        mel = whisper.log_mel_spectrogram(audio_t, modelo.dims.n_mels)
+        # Mismo dtype que el precalentamiento (y que whisper.decode con fp16)
+        # para reutilizar el grafo compilado del encoder
+        if WHISPER_FP16:
+            mel = mel.half()
+        _, probs = modelo.detect_language(mel)
+    return probs
+
+
+async def hash_audio(audio: UploadFile) -> tuple[str, int]:
+    """
+    Calcula el hash del upload leyéndolo por bloques.
+
+    Retorna (hash, tamaño en bytes) y deja el archivo al inicio.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    total = 0
+    while bloque := await audio.read(CHUNK_UPLOAD):
+        hasher.update(bloque)
+        total += len(bloque)
+    await audio.seek(0)
+    return hasher.hexdigest(), total
+
+
+def comando_ffmpeg(entrada: str) -> list[str]:
+    """Comando ffmpeg que decodifica `entrada` a PCM s16le mono 16 kHz por stdout."""
+    return [
+        "ffmpeg", "-loglevel", "error", "-i", entrada,
+        "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"
+    ]
+
+
+async def decodificar_desde_archivo(audio: UploadFile) -> tuple[bytes, bytes, int, int]:
+    """
+    Decodifica un upload MP4/M4A (ISO-BMFF) desde un archivo temporal.
+
+    El demuxer de MP4 necesita buscar el átomo moov, que en grabaciones de
+    iOS y la mayoría de grabadoras va al final: por pipe no se puede leer.
+    Retorna (pcm, stderr, código de salida, bytes recibidos).
+    """
+    with tempfile.NamedTemporaryFile(dir=TMP_DIR, suffix=".m4a") as tmp:
+        while bloque := await audio.read(CHUNK_UPLOAD):
+            tmp.write(bloque)
+        tmp.flush()
+
+        proc = await asyncio.create_subprocess_exec(
+            *comando_ffmpeg(tmp.name),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=1 << 20
+        )
+        salida, stderr = await proc.communicate()
+        return salida, stderr, proc.returncode, tmp.tell()
+
+
+async def decodificar_desde_pipe(audio: UploadFile) -> tuple[bytes, bytes, int, int]:
+    """
+    Decodifica un upload en formato streamable (OGG, WAV, MP3, ...) por pipe.
+
+    El archivo se envía a stdin por bloques mientras se lee stdout, así
+    el upload nunca se carga completo en memoria.
+    Retorna (pcm, stderr, código de salida, bytes recibidos).
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *comando_ffmpeg("pipe:0"),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=1 << 20  # buffer de 1 MB para no pausar la lectura del PCM
+    )
+
+    escrito = 0
+
+    async def escribir():
+        nonlocal escrito
+        try:
+            while bloque := await audio.read(CHUNK_UPLOAD):
+                escrito += len(bloque)
+                proc.stdin.write(bloque)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg terminó antes (formato inválido): el error sale por stderr
+            pass
+        finally:
+            proc.stdin.close()
+
+    # Escribir y leer a la vez para que ningún pipe se llene y bloquee
+    _, salida, stderr = await asyncio.gather(
+        escribir(), proc.stdout.read(), proc.stderr.read()
+    )
+    await proc.wait()
+    return salida, stderr, proc.returncode, escrito
+
+
+async def decodificar_audio(audio: UploadFile) -> np.ndarray:
+    """
+    Decodifica el upload con ffmpeg.
+
+    Retorna un array float32 mono a 16 kHz, el formato que Whisper
+    acepta directamente. MP4/M4A pasa por un archivo temporal; el resto
+    se decodifica por pipe.
+    """
+    # ISO-BMFF (MP4, M4A, MOV): "ftyp" en los bytes 4-8
+    cabecera = await audio.read(12)
+    await audio.seek(0)
+
+    if cabecera[4:8] == b"ftyp":
+        salida, stderr, codigo, recibido = await decodificar_desde_archivo(audio)
+    else:
+        salida, stderr, codigo, recibido = await decodificar_desde_pipe(audio)
+
+    if not recibido:
+        raise HTTPException(status_code=400, detail="Archivo de audio vacío")
+    if codigo != 0:
+        raise Exception(f"Error decodificando audio: {stderr.decode()}")
+
+    return np.frombuffer(salida, np.int16).astype(np.float32) / 32768.0
+
+
 @app.get("/health")
 async def health():
     """Endpoint de salud del servicio."""
-    return {"status": "ok", "servicio": "stt", "modelo": WHISPER_MODEL}
+    return {
+        "status": "ok",
+        "servicio": "stt",
+        "modelo": WHISPER_MODEL,
+        "backend": WHISPER_BACKEND,
+        "dispositivo": WHISPER_DEVICE
+    }
 
 
 @app.get("/modelos")
@@ -56,51 +499,65 @@ async def transcribir(audio: UploadFile = File(...)):
     Transcribe audio a texto.
 
     - Acepta archivos de audio (wav, mp3, m4a, ogg, opus, flac, etc.)
-    - La extensión del archivo debe ser correcta (el gateway la detecta)
+    - El formato se detecta por contenido (no depende de la extensión)
     - Detecta automáticamente el idioma
     - Retorna texto, idioma detectado y nivel de confianza
     """
-    tmp_path = None
     try:
-        # Obtener extensión del archivo (el gateway ya detectó el formato)
-        extension = os.path.splitext(audio.filename or "audio.ogg")[1] or ".ogg"
-
-        # Leer contenido
-        contenido = await audio.read()
-        if not contenido:
+        # Hash por bloques (sin cargar el archivo completo en memoria)
+        key, tamano = await hash_audio(audio)
+        if not tamano:
             raise HTTPException(status_code=400, detail="Archivo de audio vacío")
 
-        print(f"[STT] Recibido: {audio.filename} ({len(contenido)} bytes, ext={extension})")
+        log.debug("Recibido: %s (%d bytes)", audio.filename, tamano)
 
-        # Guardar archivo temporal con la extensión correcta
-        with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp:
-            tmp.write(contenido)
-            tmp_path = tmp.name
+        # Mismo audio ya transcrito: responder desde el cache
+        if key in transcripciones_cache:
+            transcripciones_cache.move_to_end(key)
+            return transcripciones_cache[key]
 
-        # Cargar modelo y transcribir
-        modelo = cargar_modelo()
-        resultado = modelo.transcribe(tmp_path)
+        # Decodificar en streaming (ffmpeg detecta el formato)
+        audio_data = await decodificar_audio(audio)
 
-        texto = resultado["text"].strip()
-        idioma = resultado["language"]
-        confianza = resultado.get("language_probability", 0.0)
-
-        print(f"[STT] Transcripción exitosa: idioma={idioma}, texto={texto[:50]}...")
+        # faster-whisper aplica el VAD internamente (vad_filter)
+        sin_voz = (
+            WHISPER_BACKEND == "openai" and WHISPER_VAD
+            and not await asyncio.to_thread(hay_voz, audio_data)
+        )
 
-        return TranscripcionResponse(
+        if sin_voz:
+            # Sin voz: no pasar por Whisper (evita alucinaciones)
+            texto, idioma, confianza = "", "es", 0.0
+        elif cola_batch is not None and len(audio_data) <= SAMPLE_RATE * 30:
+            # Clip corto: se agrupa con otras requests concurrentes
+            futuro = asyncio.get_running_loop().create_future()
+            await cola_batch.put((audio_data, futuro))
+            texto, idioma, confianza = await futuro
+        else:
+            # Transcribir en un hilo para no bloquear el event loop
+            async with modelo_lock:
+                texto, idioma, confianza = await en_hilo_modelo(transcribir_audio, audio_data)
+
+        log.debug("Transcripción exitosa: idioma=%s, texto=%.50s...", idioma, texto)
+
+        respuesta = TranscripcionResponse(
             texto=texto,
             idioma=idioma,
             confianza=confianza
         )
 
+        if STT_CACHE_SIZE > 0:
+            transcripciones_cache[key] = respuesta
+            while len(transcripciones_cache) > STT_CACHE_SIZE:
+                transcripciones_cache.popitem(last=False)
+
+        return respuesta
+
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[STT] Error al transcribir: {str(e)}")
+        log.error("Error al transcribir: %s", e)
         raise HTTPException(status_code=500, detail=f"Error al transcribir: {str(e)}")
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.unlink(tmp_path)
 
 
 @app.post("/detect-language")
@@ -108,25 +565,11 @@ async def detectar_idioma(audio: UploadFile = File(...)):
     """
     Detecta el idioma del audio sin transcribir completamente.
     """
-    tmp_path = None
     try:
-        extension = os.path.splitext(audio.filename or "audio.ogg")[1] or ".ogg"
-        contenido = await audio.read()
-
-        if not contenido:
-            raise HTTPException(status_code=400, detail="Archivo de audio vacío")
+        audio_data = await decodificar_audio(audio)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp:
-            tmp.write(contenido)
-            tmp_path = tmp.name
-
-        modelo = cargar_modelo()
-
-        # Cargar audio y detectar idioma
-        audio_data = whisper.load_audio(tmp_path)
-        audio_data = whisper.pad_or_trim(audio_data)
-        mel = whisper.log_mel_spectrogram(audio_data).to(modelo.device)
-        _, probs = modelo.detect_language(mel)
+        async with modelo_lock:
+            probs = await en_hilo_modelo(detectar_idioma_audio, audio_data)
 
         idioma = max(probs, key=probs.get)
         return {
@@ -139,12 +582,24 @@ async def detectar_idioma(audio: UploadFile = File(...)):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al detectar idioma: {str(e)}")
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.unlink(tmp_path)
 
 
 @app.on_event("startup")
 async def precargar_modelo():
     """Precarga el modelo al iniciar el servicio."""
-    cargar_modelo()
+    global cola_batch, tarea_batcher
+    # En el hilo del modelo: ahí se graban los CUDA graphs del precalentamiento
+    await en_hilo_modelo(cargar_modelo)
+
+    # El batcher usa whisper.decode, solo disponible en el backend openai
+    if WHISPER_BACKEND == "openai" and STT_BATCH_SIZE > 1:
+        cola_batch = asyncio.Queue()
+        tarea_batcher = asyncio.create_task(batcher())
+
+
+@app.on_event("shutdown")
+async def detener_batcher():
+    """Detiene el micro-batching y el hilo del modelo."""
+    if tarea_batcher is not None:
+        tarea_batcher.cancel()
+    MODELO_EXEC.shutdown(wait=False, cancel_futures=True)
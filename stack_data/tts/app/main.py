@@ -3,17 +3,35 @@ Servicio TTS - Text to Speech con detección automática de idioma
 """
 import os
 import io
-import subprocess
-import tempfile
+import asyncio
+import hashlib
+import logging
+import gc
+import wave
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
+import redis.asyncio as aioredis
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from langdetect import detect, LangDetectException
-from TTS.api import TTS
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from TTS.api import TTS
+
+# Logging (nivel configurable con LOG_LEVEL)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="[TTS] %(levelname)s %(message)s"
+)
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="TTS Service",
-    description="Servicio de síntesis de voz con detección automática de idioma"
+    description="Servicio de síntesis de voz con detección automática de idioma",
+    default_response_class=ORJSONResponse
 )
 
 # Modelos por idioma
@@ -29,75 +47,394 @@ MODELOS_TTS = {
 # Modelo por defecto desde variable de entorno
 MODELO_DEFAULT = os.getenv("COQUI_TTS_MODEL", "tts_models/es/css10/vits")
 
-# Cache de modelos cargados
-modelos_cargados = {}
+# Identificación de idioma con fastText (lid.176, ~1 ms por texto)
+FASTTEXT_LID_MODEL = os.getenv("FASTTEXT_LID_MODEL", "/models/lid.176.ftz")
+
+# Modelo fastText cargado (lazy init)
+_lid_model = None
+_lid_lock = threading.Lock()
+
+# Redis para el cache de audio
+REDIS_URL = os.getenv("REDIS_URL", "redis://:orquestador123@redis-orquestador:6379/0")
+
+# Timeouts de Redis (segundos): si no responde, se sintetiza sin cache
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+
+# Cache del audio sintetizado (0 = desactivado)
+# Guarda WAV completos en el Redis compartido: TTL corto y solo audios
+# pequeños (saludos, confirmaciones), ~44 KB por segundo de audio
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", "3600"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(256 * 1024)))
+
+# Conexión async a Redis para el audio (binario, sin decode_responses)
+_redis_audio = None
+
+# Máximo de modelos en memoria (se descarta el menos usado)
+MAX_TTS_MODELS = int(os.getenv("MAX_TTS_MODELS", "3"))
+
+# Hilos dedicados a la inferencia TTS (síntesis concurrente entre requests)
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+TTS_EXEC = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+# Backend de inferencia: "torch" (Coqui directo) u "onnx" (ONNX Runtime)
+TTS_BACKEND = os.getenv("TTS_BACKEND", "torch")
+
+# Modelos VITS exportados a ONNX (se generan la primera vez que se cargan)
+TTS_ONNX_DIR = os.getenv("TTS_ONNX_DIR", "/models/onnx")
+
+# Cuantizar pesos a int8 (quantize_dynamic) al exportar
+TTS_ONNX_INT8 = os.getenv("TTS_ONNX_INT8", "true").lower() == "true"
+
+
+class LRUModelCache:
+    """
+    Cache LRU de modelos TTS con límite de tamaño.
+
+    Thread-safe: los modelos se cargan y usan desde hilos. Un lock por
+    modelo evita cargar el mismo modelo dos veces en paralelo. Al descartar
+    un modelo se libera la memoria de GPU que tenía reservada.
+    """
+
+    def __init__(self, max_models: int):
+        self.max_models = max_models
+        self._modelos: OrderedDict[str, "TTS"] = OrderedDict()
+        self._lock = threading.Lock()
+        self._locks_carga: dict[str, threading.Lock] = {}
+
+    def _buscar(self, nombre: str) -> "TTS | None":
+        with self._lock:
+            modelo = self._modelos.get(nombre)
+            if modelo is not None:
+                self._modelos.move_to_end(nombre)
+            return modelo
+
+    def obtener(self, nombre: str, cargar: Callable[[str], "TTS"]) -> "TTS":
+        """Retorna el modelo del cache o lo carga con `cargar(nombre)`."""
+        modelo = self._buscar(nombre)
+        if modelo is not None:
+            return modelo
+
+        with self._lock:
+            lock_carga = self._locks_carga.setdefault(nombre, threading.Lock())
+
+        with lock_carga:
+            # Otro hilo pudo haberlo cargado mientras esperábamos
+            modelo = self._buscar(nombre)
+            if modelo is not None:
+                return modelo
+
+            modelo = cargar(nombre)
+            with self._lock:
+                self._modelos[nombre] = modelo
+                descartados = []
+                while len(self._modelos) > self.max_models:
+                    descartados.append(self._modelos.popitem(last=False))
+
+        if descartados:
+            del descartados
+            liberar_memoria_gpu()
+        return modelo
+
+
+def liberar_memoria_gpu():
+    """Devuelve al driver la memoria CUDA de modelos descartados."""
+    import torch
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# Cache LRU de modelos cargados
+modelos_cargados = LRUModelCache(MAX_TTS_MODELS)
+
+# Idiomas a precargar en segundo plano al iniciar (los más usados primero)
+TTS_PRELOAD = [i.strip() for i in os.getenv("TTS_PRELOAD", "es,en").split(",") if i.strip()]
+tarea_precarga: asyncio.Task | None = None
 
 
 class TextoEntrada(BaseModel):
     texto: str
     idioma: str | None = None  # Si no se especifica, se detecta automáticamente
-    speed: float = 1.3  # Velocidad del habla (1.0 = normal, >1 = más rápido)
+    speed: float = 1.3  # Velocidad del habla (los modelos VITS de Coqui la ignoran)
+
+
+class ModeloONNX:
+    """
+    Modelo VITS ejecutado con ONNX Runtime.
+
+    Del modelo Coqui solo se copian el tokenizer, el segmentador de
+    oraciones, las escalas y el sample rate; los pesos de PyTorch no se
+    conservan (se liberan en cargar_tts).
+    """
+
+    def __init__(self, tts: "TTS", ruta_onnx: str):
+        import onnxruntime as ort
+
+        vits = tts.synthesizer.tts_model
+        self.output_sample_rate = tts.synthesizer.output_sample_rate
+        self._segmentador = tts.synthesizer.seg
+        self._tokenizer = vits.tokenizer
+        self._escalas = np.array([
+            vits.inference_noise_scale,
+            vits.length_scale,
+            vits.inference_noise_scale_dp
+        ], dtype=np.float32)
+
+        opciones = ort.SessionOptions()
+        opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._sesion = ort.InferenceSession(
+            ruta_onnx, sess_options=opciones, providers=["CPUExecutionProvider"]
+        )
+        self._entradas = {e.name for e in self._sesion.get_inputs()}
+
+    def tts(self, text: str, speed: float = 1.0) -> np.ndarray:
+        """
+        Sintetiza el texto oración por oración. Retorna muestras float32.
+
+        `speed` se ignora, igual que en TTS.tts() de Coqui para VITS: ambos
+        backends usan el length_scale del modelo y suenan igual.
+        """
+        partes = []
+        for oracion in self._segmentador.segment(text):
+            ids = np.array([self._tokenizer.text_to_ids(oracion)], dtype=np.int64)
+            entradas = {
+                "input": ids,
+                "input_lengths": np.array([ids.shape[1]], dtype=np.int64),
+                "scales": self._escalas,
+            }
+            # Modelos de un solo hablante/idioma: sin sid ni langid
+            entradas = {k: v for k, v in entradas.items() if k in self._entradas}
+            partes.append(self._sesion.run(["output"], entradas)[0].reshape(-1))
+
+        return np.concatenate(partes) if partes else np.zeros(0, dtype=np.float32)
+
+
+def escribir_atomico(ruta: str, escribir: Callable[[str], None]):
+    """
+    Genera `ruta` con `escribir(ruta_temporal)` y la renombra al final.
+
+    El directorio ONNX se comparte entre réplicas: os.replace evita que
+    otra réplica (o un reinicio tras un fallo) cargue un archivo a medias.
+    """
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        escribir(temporal)
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def exportar_onnx(tts: "TTS", modelo_nombre: str) -> str:
+    """
+    Exporta el VITS del modelo a ONNX (y lo cuantiza a int8) si no existe.
+
+    Retorna la ruta del archivo a cargar.
+    """
+    base = os.path.join(TTS_ONNX_DIR, modelo_nombre.replace("/", "--"))
+    ruta = f"{base}.onnx"
+    ruta_int8 = f"{base}.int8.onnx"
+
+    if not os.path.exists(ruta):
+        log.info("Exportando a ONNX: %s", modelo_nombre)
+        os.makedirs(TTS_ONNX_DIR, exist_ok=True)
+        escribir_atomico(
+            ruta, lambda destino: tts.synthesizer.tts_model.export_onnx(output_path=destino)
+        )
+
+    if not TTS_ONNX_INT8:
+        return ruta
 
+    if not os.path.exists(ruta_int8):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
 
-def obtener_modelo(idioma: str) -> tuple[TTS, str]:
-    """Obtiene o carga el modelo TTS para el idioma especificado."""
+        log.info("Cuantizando a int8: %s", modelo_nombre)
+        escribir_atomico(
+            ruta_int8,
+            lambda destino: quantize_dynamic(ruta, destino, weight_type=QuantType.QInt8)
+        )
+    return ruta_int8
+
+
+def cargar_tts(modelo_nombre: str) -> "TTS | ModeloONNX":
+    """Carga un modelo Coqui TTS con el backend configurado."""
+    # Import pesado (torch) solo al cargar el primer modelo
+    from TTS.api import TTS
+
+    tts = TTS(modelo_nombre)
+    if TTS_BACKEND == "onnx":
+        modelo = ModeloONNX(tts, exportar_onnx(tts, modelo_nombre))
+        # Soltar los pesos de PyTorch: solo queda la sesión de ONNX Runtime
+        del tts
+        liberar_memoria_gpu()
+        return modelo
+    return tts
+
+
+def obtener_modelo(idioma: str) -> tuple["TTS | ModeloONNX", str]:
+    """
+    Obtiene o carga el modelo TTS para el idioma especificado.
+
+    Es bloqueante si hay que cargar el modelo: llamar desde un hilo.
+    """
     # Si el idioma no está soportado, usar español
     if idioma not in MODELOS_TTS:
         idioma = "es"
 
     modelo_nombre = MODELOS_TTS[idioma]
+    return modelos_cargados.obtener(modelo_nombre, cargar_tts), idioma
+
+
+def get_redis_audio() -> aioredis.Redis:
+    """Obtiene conexión async a Redis para el cache de audio (lazy init)."""
+    global _redis_audio
+    if _redis_audio is None:
+        _redis_audio = aioredis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
+    return _redis_audio
+
+
+def clave_audio(texto: str, idioma: str, speed: float) -> str:
+    """Clave del cache de audio: hash de backend, idioma, velocidad y texto."""
+    contenido = f"{TTS_BACKEND}|{idioma}|{speed:.2f}|{texto}".encode()
+    return f"tts:{hashlib.blake2b(contenido, digest_size=16).hexdigest()}"
 
-    if modelo_nombre not in modelos_cargados:
-        modelos_cargados[modelo_nombre] = TTS(modelo_nombre)
 
-    return modelos_cargados[modelo_nombre], idioma
+def respuesta_wav(audio: bytes, idioma: str) -> StreamingResponse:
+    """Respuesta HTTP con el WAV sintetizado."""
+    return StreamingResponse(
+        io.BytesIO(audio),
+        media_type="audio/wav",
+        headers={
+            "X-Detected-Language": idioma,
+            "Content-Disposition": "attachment; filename=audio.wav"
+        }
+    )
+
+
+def get_lid():
+    """Obtiene el modelo fastText de identificación de idioma (lazy init)."""
+    global _lid_model
+    with _lid_lock:
+        if _lid_model is None:
+            import fasttext
+
+            modelo = fasttext.load_model(FASTTEXT_LID_MODEL)
+            # Verificar que predict funciona (falla con NumPy 2) al cargar,
+            # no en cada request
+            modelo.predict("hola", k=1)
+            _lid_model = modelo
+    return _lid_model
 
 
 def detectar_idioma(texto: str) -> str:
-    """Detecta el idioma del texto. Si falla, retorna español."""
-    try:
-        idioma = detect(texto)
-        # Si no está soportado, usar español
-        return idioma if idioma in MODELOS_TTS else "es"
-    except LangDetectException:
-        return "es"
+    """
+    Detecta el idioma del texto. Si no está soportado, retorna español.
+
+    Los errores del detector se propagan: un fastText roto no debe
+    convertir todo el tráfico en español en silencio.
+    """
+    # fastText predice por línea: el texto debe ir sin saltos
+    labels, _ = get_lid().predict(texto.replace("\n", " "), k=1)
 
+    idioma = labels[0].removeprefix("__label__") if labels else "es"
+
+    # Si no está soportado, usar español
+    return idioma if idioma in MODELOS_TTS else "es"
+
+
+def pcm_a_wav(pcm: bytes, sample_rate: int) -> bytes:
+    """Envuelve PCM 16-bit mono en un contenedor WAV."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def normalizar_pico(muestras: np.ndarray) -> np.ndarray:
+    """
+    Normaliza al pico como save_wav de Coqui: wav / max(0.01, max|wav|).
 
-def comprimir_silencios(audio_bytes: bytes, max_silence_ms: int = 300) -> bytes:
+    Mantiene el volumen de salida de tts_to_file y que el umbral de
+    silencio se aplique sobre el mismo nivel.
     """
-    Comprime silencios largos en el audio usando ffmpeg.
+    if not len(muestras):
+        return muestras
+    return muestras / max(0.01, float(np.abs(muestras).max()))
+
+
+def comprimir_silencios(
+    muestras: np.ndarray,
+    sample_rate: int,
+    max_silence_ms: int = 300,
+    umbral_db: float = -50.0
+) -> bytes:
+    """
+    Comprime silencios largos en el audio. Retorna WAV en bytes.
     - Reduce silencios mayores a max_silence_ms
     - Mantiene pausas naturales pero más cortas
+
+    Se calcula el RMS en ventanas de 20 ms (media móvil con suma
+    acumulada) y los tramos por debajo de umbral_db se recortan,
+    conservando la mitad de la pausa a cada lado. Todo en NumPy,
+    sin subprocesos.
     """
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f_in:
-        f_in.write(audio_bytes)
-        input_path = f_in.name
+    n = len(muestras)
+    max_silencio = int(sample_rate * max_silence_ms / 1000)
+
+    if n > max_silencio:
+        # RMS centrado en una ventana de 20 ms
+        mitad = max(1, sample_rate // 100)
+        energia = np.concatenate(([0.0], np.cumsum(np.square(muestras, dtype=np.float64))))
+        idx = np.arange(n)
+        ini = np.maximum(idx - mitad, 0)
+        fin = np.minimum(idx + mitad + 1, n)
+        rms = np.sqrt((energia[fin] - energia[ini]) / (fin - ini))
+        silencio = rms < 10 ** (umbral_db / 20)
+
+        # Tramos consecutivos (run-length) de silencio / no silencio
+        cambios = np.flatnonzero(np.diff(silencio.astype(np.int8))) + 1
+        limites = np.concatenate(([0], cambios, [n]))
+
+        mantener = np.ones(n, dtype=bool)
+        cabeza = max_silencio // 2
+        cola = max_silencio - cabeza
+        for inicio, final in zip(limites[:-1], limites[1:]):
+            if silencio[inicio] and final - inicio > max_silencio:
+                mantener[inicio + cabeza:final - cola] = False
+        muestras = muestras[mantener]
+
+    pcm = (np.clip(muestras, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+    return pcm_a_wav(pcm, sample_rate)
+
+
+def generar_audio(tts: "TTS | ModeloONNX", texto: str, speed: float) -> bytes:
+    """
+    Sintetiza el texto y comprime silencios. Retorna WAV en bytes.
 
-    output_path = input_path.replace(".wav", "_compressed.wav")
+    Es bloqueante: correr en TTS_EXEC.
+    """
+    import torch
 
-    try:
-        # Filtro silenceremove: detecta silencios > 0.3s y los reduce
-        # stop_periods=-1: procesa todo el audio
-        # stop_duration: duración mínima de silencio a detectar (segundos)
-        # stop_threshold: umbral de volumen para considerar silencio (-50dB)
-        cmd = [
-            "ffmpeg", "-y", "-i", input_path,
-            "-af", f"silenceremove=stop_periods=-1:stop_duration=0.3:stop_threshold=-50dB",
-            output_path
-        ]
-        subprocess.run(cmd, capture_output=True, check=True)
-
-        with open(output_path, "rb") as f_out:
-            return f_out.read()
-    except subprocess.CalledProcessError:
-        # Si falla, retornar audio original
-        return audio_bytes
-    finally:
-        # Limpiar archivos temporales
-        if os.path.exists(input_path):
-            os.remove(input_path)
-        if os.path.exists(output_path):
-            os.remove(output_path)
+    # Generar muestras en memoria con velocidad ajustada
+    # inference_mode es por hilo: se activa aquí, dentro de TTS_EXEC
+    with torch.inference_mode():
+        muestras = np.asarray(tts.tts(text=texto, speed=speed), dtype=np.float32)
+
+    if isinstance(tts, ModeloONNX):
+        sample_rate = tts.output_sample_rate
+    else:
+        sample_rate = tts.synthesizer.output_sample_rate
+
+    # Normalizar como Coqui y comprimir silencios largos
+    return comprimir_silencios(normalizar_pico(muestras), sample_rate)
 
 
 @app.get("/health")
@@ -126,34 +463,68 @@ async def sintetizar(entrada: TextoEntrada):
     if not entrada.texto.strip():
         raise HTTPException(status_code=400, detail="El texto no puede estar vacío")
 
-    # Detectar o usar idioma especificado
-    idioma_solicitado = entrada.idioma or detectar_idioma(entrada.texto)
+    # Detectar o usar idioma especificado (si no está soportado, español)
+    try:
+        idioma = entrada.idioma or detectar_idioma(entrada.texto)
+    except Exception as e:
+        log.error("Error detectando idioma: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error detectando idioma: {str(e)}")
+    if idioma not in MODELOS_TTS:
+        idioma = "es"
+
+    # Mismo texto, idioma y velocidad ya sintetizados: responder desde Redis
+    key = clave_audio(entrada.texto, idioma, entrada.speed)
+    if TTS_CACHE_TTL > 0:
+        try:
+            cached = await get_redis_audio().get(key)
+            if cached:
+                return respuesta_wav(cached, idioma)
+        except Exception as e:
+            log.warning("Error leyendo audio de Redis: %s", e)
 
     try:
-        tts, idioma = obtener_modelo(idioma_solicitado)
-
-        # Generar audio en memoria con velocidad ajustada
-        buffer = io.BytesIO()
-        tts.tts_to_file(text=entrada.texto, file_path=buffer, speed=entrada.speed)
-        buffer.seek(0)
-
-        # Comprimir silencios largos
-        audio_comprimido = comprimir_silencios(buffer.read())
-        buffer_final = io.BytesIO(audio_comprimido)
-
-        return StreamingResponse(
-            buffer_final,
-            media_type="audio/wav",
-            headers={
-                "X-Detected-Language": idioma,
-                "Content-Disposition": "attachment; filename=audio.wav"
-            }
+        tts, idioma = await asyncio.to_thread(obtener_modelo, idioma)
+
+        # Sintetizar en el pool de TTS para no bloquear el event loop
+        loop = asyncio.get_running_loop()
+        audio_comprimido = await loop.run_in_executor(
+            TTS_EXEC, generar_audio, tts, entrada.texto, entrada.speed
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al sintetizar: {str(e)}")
 
+    if TTS_CACHE_TTL > 0 and len(audio_comprimido) <= TTS_CACHE_MAX_BYTES:
+        try:
+            await get_redis_audio().setex(key, TTS_CACHE_TTL, audio_comprimido)
+        except Exception as e:
+            log.warning("Error guardando audio en Redis: %s", e)
+
+    return respuesta_wav(audio_comprimido, idioma)
+
+
+def precargar_modelos():
+    """Carga fastText y los modelos de TTS_PRELOAD sin exceder MAX_TTS_MODELS."""
+    try:
+        get_lid()
+    except Exception as e:
+        log.error("Error cargando modelo de idioma: %s", e)
+
+    for idioma in TTS_PRELOAD[:MAX_TTS_MODELS]:
+        try:
+            obtener_modelo(idioma)
+            log.info("Modelo precargado: %s", idioma)
+        except Exception as e:
+            log.error("Error precargando modelo %s: %s", idioma, e)
+
 
 @app.on_event("startup")
-async def cargar_modelo_default():
-    """Precarga el modelo de español al iniciar."""
-    obtener_modelo("es")
+async def cargar_modelos_iniciales():
+    """Precarga en segundo plano los modelos de los idiomas más usados."""
+    global tarea_precarga
+    tarea_precarga = asyncio.create_task(asyncio.to_thread(precargar_modelos))
+
+
+@app.on_event("shutdown")
+async def cerrar_executor():
+    """Libera los hilos de síntesis."""
+    TTS_EXEC.shutdown(wait=False, cancel_futures=True)